@@ -0,0 +1,42 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+from typing import Optional
+
+# The listener which writes the enqueued log records, set once the logging is configured
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure(logfile: str = 'ffmpeg_cmd_bot.log', mode: str = 'a') -> None:
+    """
+    Configure the root logger.
+    The log records are only enqueued by the callers and written to a rotating log file
+    by a background listener thread. Calling it more than once has no effect.
+
+    :param logfile: The path of the log file.
+    :param mode: The mode used to open the log file.
+    """
+    global _listener
+
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(-1)
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        logfile, mode=mode, maxBytes=10 * 1024 * 1024, backupCount=3
+    )
+    file_handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%y-%m-%d %H:%M:%S'
+    ))
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    # Flush the pending records on exit
+    atexit.register(_listener.stop)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
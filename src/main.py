@@ -1,15 +1,25 @@
 import logging
 import os
-import io
 import traceback
 import html
-import json
+import re
+import shlex
+import reprlib
 import asyncio
-from typing import Optional, List
-from env_manager import keyring_get, keyring_initialize
-from telegram import Update, Document, Video
+import uuid
+import functools
+import tempfile
+import shutil
+import time
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Iterator
+import logging_setup
+from env_manager import keyring_initialize
+from telegram import Update, Document, Video, Message
 from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -19,22 +29,30 @@ from telegram.ext import (
     PicklePersistence
 )
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%y-%m-%d %H:%M:%S',
-    filename='ffmpeg_cmd_bot.log',
-    filemode='w'
-)
-
 # set higher logging level for httpx to avoid all GET and POST requests being logged
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-TEMP_DOWNLOAD_PATH = './temp_download_path/'
-
+# The temporary files are kept on a RAM backed file system (tmpfs) when available
+TEMP_DOWNLOAD_PATH = os.environ.get('BOT_TMP') or (
+    '/dev/shm/ffmpeg_cmd_bot/' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(), 'ffmpeg_cmd_bot')
+)
+os.makedirs(TEMP_DOWNLOAD_PATH, exist_ok=True)
+# Normalized absolute path of the temporary directory, used to build every temporary file path
+TEMP_DIR = os.path.abspath(TEMP_DOWNLOAD_PATH)
+
+# Prefix of the per conversation temporary directories
+JOB_DIR_PREFIX = 'job_'
+# Age in seconds after which a leftover job directory is deleted
+JOB_DIR_MAX_AGE = 60 * 60
+# Seconds between two sweeps of the leftover job directories
+JANITOR_INTERVAL = 15 * 60
+# Job directories of the commands being processed, never deleted by the sweeps
+ACTIVE_JOB_DIRS: set[str] = set()
+
+# Key to access to the job directory in the context
+JOB_DIR_KEY = 'job_dir'
 # Key to access to the stored file names in the context
 MEDIAGROUP_FILE_NAMES_KEY = 'mediagroup_file_names'
 # Key to access to the pre-input parts
@@ -46,11 +64,99 @@ COMMAND_KEY = 'command'
 # Key to access to the output path
 OUTPUT_PATH_KEY = 'output_path'
 
+# FFmpeg executable and flags placed at the beginning of every command
+FFMPEG_BASE_COMMAND = ('ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y')
+
+# Limits the number of FFmpeg processes running at the same time
+FFMPEG_SEMAPHORE = asyncio.Semaphore(int(os.environ.get('FFMPEG_MAX_JOBS', max(1, (os.cpu_count() or 2) // 2))))
+
+# FFmpeg options the users are allowed to pass, without their stream specifiers (e.g. -c for -c:v)
+ALLOWED_FFMPEG_OPTIONS = frozenset({
+    '-vf', '-af', '-c', '-b', '-r', '-s', '-ss', '-to', '-t', '-crf', '-preset', '-map', '-pix_fmt', '-f', '-threads'
+})
+# Matches an absolute path or a '..' path component inside a command part, such as a filter option value
+# (e.g. textfile=../secret or file=/root/x), while text like 'Loading...' doesn't match
+_PATH_PATTERN = re.compile(r"""(?:^|[=:,;'"\\])/|(?:^|[=:,;'"\\/])\.\.(?:[/\\'":,;]|$)""")
+# Maximum duration in seconds of the output, used when the users don't set its duration or end point
+FFMPEG_MAX_DURATION = '600'
+
+# Image outputs which are read from FFmpeg's standard output instead of being written to the disk,
+# mapped to the options writing a single image in the same format to a pipe
+PIPE_OUTPUT_OPTIONS = {
+    '.jpg': ('-frames:v', '1', '-f', 'mjpeg'),
+    '.jpeg': ('-frames:v', '1', '-f', 'mjpeg'),
+    '.png': ('-frames:v', '1', '-c:v', 'png', '-f', 'image2pipe'),
+}
+
+# Prefix of the file FFmpeg writes the output to, renamed to the output file only when FFmpeg succeeds
+PARTIAL_FILE_PREFIX = 'partial_'
+
+# FFmpeg processes currently running, terminated when the bot shuts down
+LIVE_PROCESSES: set[asyncio.subprocess.Process] = set()
+# Set when the bot receives a stop signal, the queued jobs don't start FFmpeg anymore
+SHUTDOWN_EVENT = asyncio.Event()
+# Seconds given to FFmpeg to exit after being terminated, before killing it
+PROCESS_TERMINATE_TIMEOUT = 5
+# Number of threads running the blocking file operations
+IO_WORKERS = 8
+# Background tasks running for the whole life of the bot, cancelled when it shuts down
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+# Translation table used to strip double quotes from the input file names
+_STRIP_QUOTES = str.maketrans('', '', '"')
+
+# Number of trailing bytes of the FFmpeg output written to the log and sent when FFmpeg fails,
+# small enough to fit a Telegram message
+FFMPEG_LOG_TAIL_BYTES = 2048
+
+# Buffer size used to write the downloaded files
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# Buffer size used to read the files to upload
+UPLOAD_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Maximum size of a file which can be sent by a bot
+MAX_SEND_BYTES = 50 * 1024 * 1024
+
+# Output extensions sent as videos, Telegram clients only play MPEG4 videos
+VIDEO_EXTENSIONS = frozenset({'.mp4'})
+
+# Maximum length of a Telegram text message
+MAX_MESSAGE_LENGTH = 4096
+# Maximum length of each of the three reprs embedded in the error report,
+# leaving a quarter of the message for the markup and the HTML escaping
+MAX_ERROR_REPR_LENGTH = (MAX_MESSAGE_LENGTH - MAX_MESSAGE_LENGTH // 4) // 3
+
+# Text sent in reply to the /start command
+WELCOME_TEXT = ("Use the /init command to start a conversation with the bot!\n"
+                "Please don't insert arguments after the output file name. Only one output is currently supported.\n"
+                "Use the /init command to start the command conversation.\n"
+                "The input file/s name is automatically retrieved from the file.")
+
+# Builds the error report sent to the developer
+_format_error_message = (
+    "An exception was raised while handling an update\n"
+    "<pre>update = {update}</pre>\n\n"
+    "<pre>context.chat_data = {chat_data}</pre>\n\n"
+    "<pre>context.user_data = {user_data}</pre>\n\n"
+).format
+
+# Bounded repr used to describe the update and the context data in the error reports
+_ERROR_REPR = reprlib.Repr()
+_ERROR_REPR.maxlist = 10
+_ERROR_REPR.maxdict = 20
+_ERROR_REPR.maxstring = 200
+
+# Filter for the media accepted as input files
+MEDIA_FILTER = filters.Document.IMAGE | filters.Document.VIDEO | filters.PHOTO | filters.VIDEO
+# Filter for the text messages which aren't commands
+TEXT_NO_CMD = filters.TEXT & ~filters.COMMAND
+
 # states definitions for top-level conv handler
 DOCUMENT_SENDING, COMMAND_WAITING, PRE_INPUT_STATE, POST_INPUT_STATE = map(chr, range(4))
 
 
-def parse_ffmpeg_command(pre_input_parts: List[str], post_input_parts: List[str], input_file_names: List[str]) -> tuple[list[str], Optional[str]]:
+def parse_ffmpeg_command(pre_input_parts: List[str], post_input_parts: List[str], input_file_names: List[str],
+                         output_dir: str) -> tuple[list[str], Optional[str]]:
     """
     Constructs an FFmpeg command string from pre-input parts, input file names, and post-input parts.
 
@@ -58,22 +164,31 @@ def parse_ffmpeg_command(pre_input_parts: List[str], post_input_parts: List[str]
         pre_input_parts (List[str]): FFmpeg options to place before the input files.
         post_input_parts (List[str]): FFmpeg options to place after the input files.
         input_file_names (List[str]): The input file names.
+        output_dir (str): The directory where the output file is written.
 
     Returns:
         A tuple containing the constructed FFmpeg command parts and the output file name.
     """
-    # Initialize effective_command_parts with 'ffmpeg'
-    effective_command_parts = ['ffmpeg']
-
-    # Add pre-input parts (removing double quotes)
-    effective_command_parts.extend([part.replace('"', '') for part in pre_input_parts])
+    # Initialize effective_command_parts with 'ffmpeg', the flags which keep its output to errors only,
+    # and the pre-input parts (already unquoted by shlex)
+    effective_command_parts = [*FFMPEG_BASE_COMMAND, *pre_input_parts]
 
     # Extend the list with '-i' followed by the input file names (removing double quotes from file names)
     for input_file_name in input_file_names:
-        effective_command_parts.extend(['-i', input_file_name.replace('"', '')])
+        effective_command_parts.extend(('-i', input_file_name.translate(_STRIP_QUOTES)))
+
+    # Let the encoder pick the number of threads, placed after the inputs so it applies to the output
+    # and before the post-input parts so a -threads option of the user overrides it
+    effective_command_parts.extend(('-threads', '0'))
+
+    # Cap the duration of the output, unless the user already did it. -t takes priority over -to,
+    # so it's not added when the user sets the end point either
+    user_parts = {*pre_input_parts, *post_input_parts}
+    if '-t' not in user_parts and '-to' not in user_parts:
+        effective_command_parts.extend(('-t', FFMPEG_MAX_DURATION))
 
-    # Add post-input parts (removing double quotes)
-    effective_command_parts.extend([part.replace('"', '') for part in post_input_parts])
+    # Add post-input parts (already unquoted by shlex)
+    effective_command_parts.extend(post_input_parts)
 
     output_file = None
 
@@ -81,39 +196,201 @@ def parse_ffmpeg_command(pre_input_parts: List[str], post_input_parts: List[str]
     # but ensure it is not a parameter or an option.
     # Basic check: not starting with '-' and contains a dot (.)
     if effective_command_parts[-1] and not effective_command_parts[-1].startswith('-') and '.' in effective_command_parts[-1]:
-        output_file = TEMP_DOWNLOAD_PATH + effective_command_parts[-1]  # Ensure TEMP_DOWNLOAD_PATH is defined elsewhere
+        # Keep only the file name so the output can't be written outside the output directory
+        output_file = os.path.join(output_dir, os.path.basename(effective_command_parts[-1]))
         effective_command_parts[-1] = output_file
 
     return effective_command_parts, output_file
 
 
-def delete_temp_files(context: ContextTypes.DEFAULT_TYPE) -> None:
+def pipe_output_command(command_parts: List[str], output_file: Optional[str]) -> Optional[list[str]]:
     """
-    Deletes temporary files from the file system based on lists stored in the context.
+    Rewrites a command producing a single image so that FFmpeg writes it to its standard output,
+    avoiding to write the output file to the disk and to read it back.
+
+    Args:
+        command_parts (List[str]): The FFmpeg command parts.
+        output_file (Optional[str]): The output file of the command.
+
+    Returns:
+        The rewritten command parts, None if the output can't be piped.
+    """
+    # The user already chose the output format
+    if output_file is None or command_parts[-1] != output_file or '-f' in command_parts:
+        return None
+
+    pipe_options = PIPE_OUTPUT_OPTIONS.get(os.path.splitext(output_file)[1].lower())
+    if pipe_options is None:
+        return None
+
+    return [*command_parts[:-1], *pipe_options, 'pipe:1']
+
+
+def validate_command_parts(parts: List[str], allow_output: bool) -> Optional[str]:
+    """
+    Checks that the command parts sent by a user only contain allowed options with their values
+    and, at most, the output file name, so FFmpeg can't write files outside the job directory.
+
+    Args:
+        parts (List[str]): The command parts sent by the user.
+        allow_output (bool): Whether the last part can be the output file name.
+
+    Returns:
+        A message describing the first invalid part, None if all the parts are valid.
+    """
+    expects_value = False
+    for i, part in enumerate(parts):
+        # Paths leaving the job directory are never allowed, not even inside option values
+        if _PATH_PATTERN.search(part):
+            return f"Paths are not allowed in the command: {part}"
+
+        if expects_value:
+            expects_value = False
+            continue
+
+        if part.startswith('-') and len(part) > 1:
+            if part.split(':', 1)[0] not in ALLOWED_FFMPEG_OPTIONS:
+                return f"The option {part} is not allowed"
+            # Every allowed option takes a value
+            expects_value = True
+        elif allow_output and i == len(parts) - 1:
+            # The output file name must not point to another directory
+            if os.path.basename(part) != part or part in ('.', '..'):
+                return f"Paths are not allowed in the command: {part}"
+        else:
+            return f"Unexpected argument {part}, only the output file name can follow the options"
+
+    if expects_value:
+        return f"The option {parts[-1]} needs a value"
+
+    return None
+
+
+def _create_job_dir(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """
+    Creates the temporary directory of the conversation, unless it already exists.
 
     Args:
         context (ContextTypes.DEFAULT_TYPE): The context object containing user data.
+
+    Returns:
+        The path of the job directory.
     """
-    # Retrieve file lists from context, defaulting to empty lists if not found
-    media_group_file_names = context.user_data.get(MEDIAGROUP_FILE_NAMES_KEY, [])
-    output_path = context.user_data.get(OUTPUT_PATH_KEY, [])
+    job_dir = context.user_data.get(JOB_DIR_KEY)
+    if job_dir is None or not os.path.isdir(job_dir):
+        job_dir = tempfile.mkdtemp(prefix=JOB_DIR_PREFIX, dir=TEMP_DIR)
+        context.user_data[JOB_DIR_KEY] = job_dir
 
-    # Concatenate the lists to get a combined list of files to delete
-    media_group_file_names.append(output_path)
+    return job_dir
 
-    # Deleting files from the file system
-    for input_file in media_group_file_names:
-        if os.path.exists(input_file):
-            os.remove(input_file)
 
+def _sweep_stale_job_dirs(max_age: float = JOB_DIR_MAX_AGE, active_job_dirs: frozenset[str] = frozenset()) -> None:
+    """
+    Deletes the job directories left behind by conversations which never ended,
+    for example because the bot was restarted.
+
+    Args:
+        max_age (float): The age in seconds after which a job directory is deleted.
+        active_job_dirs (frozenset[str]): The job directories of the commands being processed,
+            which are kept whatever their age.
+    """
+    cutoff = time.time() - max_age
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            if not entry.name.startswith(JOB_DIR_PREFIX) or entry.path in active_job_dirs:
+                continue
+
+            try:
+                is_stale = entry.is_dir() and entry.stat().st_mtime < cutoff
+            except FileNotFoundError:
+                # The conversation ended and deleted it in the meantime
+                continue
+
+            if is_stale:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _is_processing(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Tells if the command of the conversation is being processed.
+    Updates are handled concurrently, so the conversation is still in the post-input state while
+    FFmpeg runs and the callbacks of that state must not touch the job directory.
+
+    Args:
+        context (ContextTypes.DEFAULT_TYPE): The context object containing user data.
+
+    Returns:
+        True if the job directory of the conversation is in use by a running command.
+    """
+    return context.user_data.get(JOB_DIR_KEY) in ACTIVE_JOB_DIRS
+
+
+async def delete_temp_files(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Deletes the temporary directory of the conversation, with all the files it contains.
+    The deletion runs in a worker thread so the event loop is not blocked.
+
+    Args:
+        context (ContextTypes.DEFAULT_TYPE): The context object containing user data.
+    """
+    job_dir = context.user_data.get(JOB_DIR_KEY)
+    if job_dir:
+        await asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True)
+
+
+def _write_file(file_path: str, data: bytes) -> None:
+    """
+    Writes the data to a file using a large buffer.
+
+    Args:
+        file_path (str): The path of the file to write.
+        data (bytes): The content of the file.
+    """
+    with open(file_path, 'wb', buffering=DOWNLOAD_BUFFER_SIZE) as file:
+        file.write(data)
+
+
+def _truncate_middle(text: str, limit: int) -> str:
+    """
+    Shortens a string to about `limit` characters, keeping its beginning and its end.
+
+    Args:
+        text (str): The string to shorten.
+        limit (int): The maximum length of the kept parts.
+
+    Returns:
+        The string itself if it's short enough, its head and tail joined by a marker otherwise.
+    """
+    if len(text) <= limit:
+        return text
+
+    half = limit // 2
+    return f"{text[:half]}\n...[truncated]...\n{text[-half:]}"
+
+
+def _chunks(text: str, size: int) -> Iterator[str]:
+    """
+    Lazily splits a string into consecutive parts of at most `size` characters.
+
+    Args:
+        text (str): The string to split.
+        size (int): The maximum length of each part.
+
+    Returns:
+        An iterator over the parts of the string.
+    """
+    for i in range(0, len(text), size):
+        yield text[i: i + size]
 
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, dev_id: str):
     """
     The error callback function.
     This function is used to handle possible Telegram API errors that aren't handled.
 
     :param update: The Telegram update.
     :param context: The Telegram context.
+    :param dev_id: The Telegram ID of the developer which receives the error reports.
     """
     # Log the error before we do anything else, so we can see it even if something breaks.
     logger.error("Exception while handling an update:", exc_info=context.error)
@@ -123,29 +400,32 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
     tb_string = "".join(tb_list)
 
-    # Split the traceback into smaller parts
-    tb_parts = [tb_string[i: i + 4096] for i in range(0, len(tb_string), 4096)]
-
     # Build the message with some markup and additional information about what happened.
     update_str = update.to_dict() if isinstance(update, Update) else str(update)
-    base_message = (
-        f"An exception was raised while handling an update\n"
-        f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
-        "</pre>\n\n"
-        f"<pre>context.chat_data = {html.escape(str(context.chat_data))}</pre>\n\n"
-        f"<pre>context.user_data = {html.escape(str(context.user_data))}</pre>\n\n"
+    base_message = _format_error_message(
+        update=html.escape(_truncate_middle(_ERROR_REPR.repr(update_str), MAX_ERROR_REPR_LENGTH)),
+        chat_data=html.escape(_truncate_middle(_ERROR_REPR.repr(context.chat_data), MAX_ERROR_REPR_LENGTH)),
+        user_data=html.escape(_truncate_middle(_ERROR_REPR.repr(context.user_data), MAX_ERROR_REPR_LENGTH))
     )
 
     # Send base message
-    await context.bot.send_message(
-        chat_id=keyring_get('DevId'), text=base_message, parse_mode=ParseMode.HTML
+    base_send = context.bot.send_message(
+        chat_id=dev_id, text=base_message, parse_mode=ParseMode.HTML
     )
 
     # Send each part of the traceback as a separate message
-    for part in tb_parts:
-        await context.bot.send_message(
-            chat_id=keyring_get('DevId'), text=f"<pre>{html.escape(part)}</pre>", parse_mode=ParseMode.HTML
+    part_sends = [
+        context.bot.send_message(
+            chat_id=dev_id, text=f"<pre>{html.escape(part)}</pre>", parse_mode=ParseMode.HTML
         )
+        for part in _chunks(tb_string, MAX_MESSAGE_LENGTH)
+    ]
+
+    # Dispatch all the messages concurrently, a failed message doesn't stop the others
+    results = await asyncio.gather(base_send, *part_sends, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Unable to send the error report to the developer:", exc_info=result)
 
 
 async def start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -153,19 +433,19 @@ async def start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     The callback called when the bot receive the classical start command on a new conversation.
     It calls db_get_chat from dbjson file to read the chat or initialize it
     """
-    welcome_text = ("Use the /init command to start a conversation with the bot!\n"
-                    "Please don't insert arguments after the output file name. Only one output is currently supported.\n"
-                    "Use the /init command to start the command conversation.\n"
-                    "The input file/s name is automatically retrieved from the file.")
-    await update.message.reply_text(welcome_text, ParseMode.MARKDOWN)
+    await update.message.reply_text(WELCOME_TEXT, ParseMode.MARKDOWN)
 
 
 async def init_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.effective_message.reply_text("Send one image or video as document or in a normal way (compressed).\n\n"
                                               "Take care that telegram's bots accept files up to 20MB only")
 
+    # The persisted user_data may still point to files and directories wiped by a previous run
+    await delete_temp_files(context)
+    context.user_data.clear()
     # initialize the user_data dictionary
-    context.user_data.setdefault(MEDIAGROUP_FILE_NAMES_KEY, [])
+    context.user_data[MEDIAGROUP_FILE_NAMES_KEY] = []
+    _create_job_dir(context)
 
     return DOCUMENT_SENDING
 
@@ -187,21 +467,30 @@ async def document_sending_callback(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("The size of the file can't be 0")
         return DOCUMENT_SENDING
 
+    # Refuse the file if the temporary directory can't hold it
+    fs_stat = os.statvfs(TEMP_DIR)
+    if file_size and file_size > fs_stat.f_bavail * fs_stat.f_frsize:
+        logger.warning(f"File of {file_size} bytes exceeds the free space available in {TEMP_DIR}")
+        await update.effective_message.reply_text("The bot is running out of space, try again later.")
+        return COMMAND_WAITING if context.user_data[MEDIAGROUP_FILE_NAMES_KEY] else DOCUMENT_SENDING
+
     file = await attachment.get_file()
-    input_file_name = TEMP_DOWNLOAD_PATH
+    job_dir = _create_job_dir(context)
     if isinstance(attachment, Document):
-        input_file_name += attachment.file_name
+        # Keep only the file name so the input can't be written outside the job directory
+        input_file_name = os.path.join(job_dir, os.path.basename(attachment.file_name))
     elif isinstance(attachment, Video):
-        input_file_name += f"{attachment.file_unique_id}.{attachment.mime_type.split('/')[1]}"
+        input_file_name = os.path.join(job_dir, f"{attachment.file_unique_id}.{attachment.mime_type.split('/')[1]}")
     else:
-        input_file_name += f"{attachment.file_unique_id}.jpg"
+        input_file_name = os.path.join(job_dir, f"{attachment.file_unique_id}.jpg")
 
     # add the file name to the MEDIAGROUP_FILE_NAMES list in user_data dictionary
     context.user_data[MEDIAGROUP_FILE_NAMES_KEY].append(input_file_name)
 
-    # download the file
-    file_path = await file.download_to_drive(input_file_name)
-    logger.info(f"File {input_file_name} temporarily saved in the filepath: {file_path}")
+    # download the file in memory and write it to the disk from a worker thread
+    data = await file.download_as_bytearray()
+    await asyncio.to_thread(_write_file, input_file_name, data)
+    logger.info(f"File {input_file_name} temporarily saved")
 
     if message.media_group_id is None:
         await update.effective_message.reply_text('Send me other files or send the /pre or /post command')
@@ -231,7 +520,18 @@ async def command_waiting_callback(update: Update, context: ContextTypes.DEFAULT
 
 async def pre_input_command_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.effective_message.text
-    parts = text.split()
+    try:
+        # shlex keeps quoted arguments containing spaces together
+        parts = shlex.split(text)
+    except ValueError:
+        await update.effective_message.reply_text('The command contains unbalanced quotes, send it again.')
+        return PRE_INPUT_STATE
+
+    error_message = validate_command_parts(parts, allow_output=False)
+    if error_message is not None:
+        await update.effective_message.reply_text(f'{error_message}, send the command again.')
+        return PRE_INPUT_STATE
+
     file_plural = 'file' if len(context.user_data[MEDIAGROUP_FILE_NAMES_KEY]) == 1 else 'files'
 
     context.user_data[PRE_INPUT_PARTS_KEY] = parts
@@ -243,7 +543,17 @@ async def pre_input_command_callback(update: Update, context: ContextTypes.DEFAU
 
 async def post_input_command_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.effective_message.text
-    parts = text.split()
+    try:
+        # shlex keeps quoted arguments containing spaces together
+        parts = shlex.split(text)
+    except ValueError:
+        await update.effective_message.reply_text('The command contains unbalanced quotes, send it again.')
+        return POST_INPUT_STATE
+
+    error_message = validate_command_parts(parts, allow_output=True)
+    if error_message is not None:
+        await update.effective_message.reply_text(f'{error_message}, send the command again.')
+        return POST_INPUT_STATE
 
     context.user_data[POST_INPUT_PARTS_KEY] = parts
     file_plural = 'file' if len(context.user_data[MEDIAGROUP_FILE_NAMES_KEY]) == 1 else 'files'
@@ -252,71 +562,176 @@ async def post_input_command_callback(update: Update, context: ContextTypes.DEFA
     effective_command_parts, output_file = parse_ffmpeg_command(
         context.user_data.get(PRE_INPUT_PARTS_KEY, []),
         context.user_data[POST_INPUT_PARTS_KEY],
-        context.user_data[MEDIAGROUP_FILE_NAMES_KEY]
+        context.user_data[MEDIAGROUP_FILE_NAMES_KEY],
+        _create_job_dir(context)
     )
 
     context.user_data[COMMAND_KEY] = effective_command_parts
     context.user_data[OUTPUT_PATH_KEY] = output_file
 
     await update.effective_message.reply_text(f"This is the command that will be applied to the {file_plural}:\n"
-                                              f"`{' '.join(effective_command_parts)}`", ParseMode.MARKDOWN)
-
-    await update.effective_message.reply_text('Send:\n- /process command to generate the output.\n'
-                                              '- /reset to delete the command inserted.\n'
-                                              '- /stop to close the conversation.')
+                                              f"`{shlex.join(effective_command_parts)}`\n\n"
+                                              "Send:\n- /process command to generate the output.\n"
+                                              "- /reset to delete the command inserted.\n"
+                                              "- /stop to close the conversation.", ParseMode.MARKDOWN)
 
     return POST_INPUT_STATE
 
 
-async def command_processing_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # Create subprocess, redirect the standard output and error to subprocess.PIPE
-    process = await asyncio.create_subprocess_exec(
-        *context.user_data[COMMAND_KEY],
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-
-    # Wait for the subprocess to finish, and get the output and error
-    stdout, stderr = await process.communicate()
-
-    # Convert stderr to a BytesIO object
-    stderr_bytesio = io.BytesIO(stderr)
-
-    # Send the output as a document directly from memory
-    stderr_bytesio.name = "ffmpeg_output.txt"  # Telegram requires a filename to send as a document
-    await update.message.reply_document(document=stderr_bytesio, caption="FFmpeg output")
-
-    # Log the FFmpeg output
-    logger.info(f"FFmpeg output: {stderr.decode()}")
+async def _reply_output_file(message: Message, output_file: Optional[str], output_data: Optional[bytes] = None) -> None:
+    """
+    Sends back the processed file, if it exists.
 
-    output_file = context.user_data[OUTPUT_PATH_KEY]
+    Args:
+        message (Message): The message to reply to.
+        output_file (Optional[str]): The path of the processed file.
+        output_data (Optional[bytes]): The content of the processed file, when it was read from FFmpeg's
+            standard output instead of being written to the disk.
+    """
+    if output_data is not None:
+        output_size = len(output_data)
+    else:
+        # A single stat tells both if the file exists and its size
+        try:
+            output_size = os.stat(output_file).st_size
+        except (FileNotFoundError, TypeError):
+            output_size = 0
 
     # sending back the processed photo if exists
-    if output_file and os.path.exists(output_file) and os.path.getsize(output_file) != 0:
-        if (os.path.getsize(output_file) / (1024 * 1024)) > 50:
-            await update.effective_message.reply_text('The output file is bigger than 50MB so it can\'t be sent from a bot.')
+    if output_size:
+        if output_size > MAX_SEND_BYTES:
+            await message.reply_text('The output file is bigger than 50MB so it can\'t be sent from a bot.')
+        elif output_data is not None:
+            await message.reply_document(document=output_data, filename=os.path.basename(output_file))
+        elif os.path.splitext(output_file)[1].lower() in VIDEO_EXTENSIONS:
+            # Videos can be played directly in the chat while they are downloaded
+            with open(output_file, 'rb', buffering=UPLOAD_BUFFER_SIZE) as file:
+                await message.reply_video(video=file, supports_streaming=True)
         else:
-            with open(output_file, 'rb') as file:
-                await update.effective_message.reply_document(document=file)
-            os.remove(output_file)  # Clean up after sending
+            with open(output_file, 'rb', buffering=UPLOAD_BUFFER_SIZE) as file:
+                await message.reply_document(document=file)
     else:
-        await update.effective_message.reply_text('There is a problem with the output file, try to change files or command.')
+        await message.reply_text('There is a problem with the output file, try to change files or command.')
 
-    # Deleting files from the file system
-    delete_temp_files(context)
 
-    # Wiping user_data
-    context.user_data.clear()
+async def command_processing_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if _is_processing(context):
+        await update.effective_message.reply_text('Your command is already being processed, wait for its output.')
+        return POST_INPUT_STATE
+
+    job_dir = _create_job_dir(context)
+    # The FFmpeg output is streamed to a file instead of being buffered in memory
+    log_path = os.path.join(job_dir, f'ffmpeg_{uuid.uuid4().hex}.log')
+    ACTIVE_JOB_DIRS.add(job_dir)
+    try:
+        with open(log_path, 'w+b') as log_file:
+            if FFMPEG_SEMAPHORE.locked():
+                await update.effective_message.reply_text('All the workers are busy, your command has been queued.')
+
+            # Small image outputs are read from the standard output instead of the disk
+            output_file = context.user_data[OUTPUT_PATH_KEY]
+            command = context.user_data[COMMAND_KEY]
+            piped_command = pipe_output_command(command, output_file)
+
+            partial_file = None
+            if piped_command is None and output_file is not None and command[-1] == output_file:
+                # FFmpeg writes to a partial file, so a failed run never leaves a half written output
+                partial_file = os.path.join(os.path.dirname(output_file),
+                                            PARTIAL_FILE_PREFIX + os.path.basename(output_file))
+                command = [*command[:-1], partial_file]
+
+            async with FFMPEG_SEMAPHORE:
+                # Queued jobs don't start once the bot is shutting down
+                if SHUTDOWN_EVENT.is_set():
+                    await update.effective_message.reply_text('The bot is shutting down, try again later with /init.')
+                    return ConversationHandler.END
+
+                # Create subprocess, redirect the standard error to the log file.
+                # The log is written by FFmpeg itself, so it never goes through a pipe buffered by the bot.
+                # Running it in the job directory keeps any relative path inside of it
+                process = await asyncio.create_subprocess_exec(
+                    *(piped_command or command),
+                    stdout=asyncio.subprocess.PIPE if piped_command else asyncio.subprocess.DEVNULL,
+                    stderr=log_file,
+                    cwd=job_dir
+                )
+
+                # Wait for the subprocess to finish, reading the piped output if any
+                LIVE_PROCESSES.add(process)
+                try:
+                    # The shutdown may have started while the process was being created
+                    if SHUTDOWN_EVENT.is_set():
+                        await _terminate_process(process)
+                    output_data, _ = await process.communicate()
+                finally:
+                    LIVE_PROCESSES.discard(process)
+
+            if process.returncode == 0 and partial_file is not None:
+                await asyncio.to_thread(os.replace, partial_file, output_file)
+
+            log_tail = ''
+            log_size = os.fstat(log_file.fileno()).st_size
+            if log_size != 0:
+                # Log only the tail of the FFmpeg output
+                log_file.seek(max(0, log_size - FFMPEG_LOG_TAIL_BYTES))
+                tail = log_file.read()
+                if log_size > FFMPEG_LOG_TAIL_BYTES:
+                    # Skip the partial line the tail starts in, unless it's the only line of the tail
+                    newline = tail.find(b'\n')
+                    if newline != -1 and newline + 1 < len(tail):
+                        tail = tail[newline + 1:]
+                log_tail = tail.decode(errors='replace')
+                logger.info(f"FFmpeg output: {log_tail}")
+
+            # The uploads to Telegram are independent, so they are run concurrently
+            pending = []
+
+            if process.returncode == 0:
+                pending.append(_reply_output_file(update.effective_message, output_file, output_data))
+            elif SHUTDOWN_EVENT.is_set():
+                pending.append(update.effective_message.reply_text(
+                    'The bot is shutting down and your command has been stopped, try again later with /init.'
+                ))
+            else:
+                # The partial output is deleted with the job directory
+                pending.append(update.effective_message.reply_text(
+                    f"FFmpeg failed with exit code {process.returncode}:\n"
+                    f"<pre>{html.escape(log_tail)}</pre>",
+                    parse_mode=ParseMode.HTML
+                ))
+
+            if log_size != 0:
+                # Send the output as a document directly from the log file
+                log_file.seek(0)
+                pending.append(
+                    update.message.reply_document(document=log_file, filename='ffmpeg_output.txt', caption="FFmpeg output")
+                )
+
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Unable to send the command result to the user:", exc_info=result)
+    finally:
+        # Deleting the job directory, even when the processing fails
+        await delete_temp_files(context)
+        ACTIVE_JOB_DIRS.discard(job_dir)
+
+        # Wiping user_data
+        context.user_data.clear()
 
-    # No need to delete the BytesIO object, it will be cleaned up by Python's garbage collector
     return ConversationHandler.END
 
 
 async def stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.debug('Stop callback called!')
 
+    if _is_processing(context):
+        await update.effective_message.reply_text('Your command is being processed and it can\'t be stopped, '
+                                                  'wait for its output.')
+        return POST_INPUT_STATE
+
     # Deleting files from the file system
-    delete_temp_files(context)
+    await delete_temp_files(context)
     # Wiping user_data
     context.user_data.clear()
 
@@ -325,23 +740,138 @@ async def stop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     return ConversationHandler.END
 
 
+async def _terminate_process(process: asyncio.subprocess.Process) -> None:
+    """
+    Terminates a process, killing it if it doesn't exit in time.
+
+    Args:
+        process (asyncio.subprocess.Process): The process to terminate.
+    """
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), PROCESS_TERMINATE_TIMEOUT)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+
+
+def _request_shutdown(application: Application) -> None:
+    """
+    Handles the stop signals: terminates the running FFmpeg processes, prevents the queued jobs
+    from starting new ones and stops the bot.
+    The processes must be terminated before the application stops, since stopping it waits for
+    all the running handlers, and so for their FFmpeg processes.
+
+    Args:
+        application (Application): The Telegram application.
+    """
+    if SHUTDOWN_EVENT.is_set():
+        return
+
+    SHUTDOWN_EVENT.set()
+    for process in list(LIVE_PROCESSES):
+        BACKGROUND_TASKS.add(asyncio.create_task(_terminate_process(process)))
+
+    application.stop_running()
+
+
+async def _janitor() -> None:
+    """
+    Periodically deletes the job directories left behind by conversations which never ended.
+    """
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        try:
+            # A long queued or running command doesn't update the mtime of its job directory
+            await asyncio.to_thread(_sweep_stale_job_dirs, JOB_DIR_MAX_AGE, frozenset(ACTIVE_JOB_DIRS))
+        except OSError:
+            # Keep the janitor running, the next sweep may succeed
+            logger.exception('Unable to sweep the job directories')
+
+
+async def post_init_callback(application: Application) -> None:
+    """
+    Configures the event loop and starts the background tasks once the bot is initialized.
+
+    Args:
+        application (Application): The Telegram application.
+    """
+    # Bound the threads used by asyncio.to_thread for the blocking file operations
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='ffbot-io')
+    )
+
+    BACKGROUND_TASKS.add(asyncio.create_task(_janitor()))
+
+    # The stop signals are handled by the bot instead of the application, see _request_shutdown
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(stop_signal, _request_shutdown, application)
+        except NotImplementedError:
+            # Signal handlers aren't supported by the Windows event loops
+            pass
+
+
+async def post_shutdown_callback(application: Application) -> None:
+    """
+    Stops the background tasks and deletes the temporary files when the bot shuts down.
+
+    Args:
+        application (Application): The Telegram application.
+    """
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    BACKGROUND_TASKS.clear()
+
+    await asyncio.to_thread(_sweep_stale_job_dirs, 0)
+
+
 async def other_messages_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.effective_message.reply_text("Please in order to use this BOT, use the /init command.")
 
 
 def main() -> None:
+    # Setup logging
+    logging_setup.configure()
+
+    # Use the libuv based event loop when available
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logger.info('uvloop is not available, using the default event loop')
+
     # Initialize the keyring
-    if not keyring_initialize():
+    keyring = keyring_initialize()
+    if keyring is None:
         exit(0xFF)
 
-    # Initialize the Pickle database
-    persistence = PicklePersistence(filepath='DB.pkl')
+    # Delete the temporary files left behind by a previous run, its conversations are gone
+    _sweep_stale_job_dirs(0)
+
+    # Initialize the Pickle database, flushing it periodically and split per data type
+    persistence = PicklePersistence(filepath='DB.pkl', update_interval=60, single_file=False, on_flush=False)
 
     # Initialize Application
-    application = Application.builder().token(keyring_get('Telegram')).persistence(persistence).build()
+    application = (
+        Application.builder()
+        .token(keyring.telegram)
+        .persistence(persistence)
+        .concurrent_updates(True)
+        .connection_pool_size(64)
+        .pool_timeout(30)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(60)
+        .rate_limiter(AIORateLimiter())
+        .post_init(post_init_callback)
+        .post_shutdown(post_shutdown_callback)
+        .build()
+    )
 
     # Assign an error handler
-    application.add_error_handler(error_handler)
+    application.add_error_handler(functools.partial(error_handler, dev_id=keyring.dev_id))
 
     # Configure the commands dispatcher
     application.add_handler(CommandHandler('start', start_callback))
@@ -351,22 +881,22 @@ def main() -> None:
         name='ffmpeg_command_conv_handler_v1',
         states={
             DOCUMENT_SENDING: [
-                MessageHandler(filters.Document.IMAGE | filters.Document.VIDEO | filters.PHOTO | filters.VIDEO, document_sending_callback),
+                MessageHandler(MEDIA_FILTER, document_sending_callback),
                 CommandHandler('stop', stop_callback)
             ],
             COMMAND_WAITING: [
-                MessageHandler(filters.Document.IMAGE | filters.Document.VIDEO | filters.PHOTO | filters.VIDEO, document_sending_callback),
+                MessageHandler(MEDIA_FILTER, document_sending_callback),
                 CommandHandler('pre', command_waiting_callback),
                 CommandHandler('post', command_waiting_callback),
                 CommandHandler('reset', command_waiting_callback),
                 CommandHandler('stop', stop_callback)
             ],
             PRE_INPUT_STATE: [
-                MessageHandler(filters.TEXT, pre_input_command_callback),
+                MessageHandler(TEXT_NO_CMD, pre_input_command_callback),
                 CommandHandler('stop', stop_callback)
             ],
             POST_INPUT_STATE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, post_input_command_callback),
+                MessageHandler(TEXT_NO_CMD, post_input_command_callback),
                 CommandHandler('stop', stop_callback),
                 CommandHandler('reset', command_waiting_callback),
                 CommandHandler('process', command_processing_callback)
@@ -378,8 +908,21 @@ def main() -> None:
     # Handles all the other types of messages
     application.add_handler(MessageHandler(filters.TEXT, other_messages_handler))
 
-    # Start the bot polling
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    if webhook_url:
+        # Let Telegram push the updates to the bot, the TLS termination is left to a reverse proxy
+        application.run_webhook(
+            listen=os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.environ.get('WEBHOOK_PORT', '8443')),
+            url_path=keyring.telegram,
+            webhook_url=f"{webhook_url.rstrip('/')}/{keyring.telegram}",
+            secret_token=os.environ.get('WEBHOOK_SECRET'),
+            allowed_updates=Update.ALL_TYPES,
+            stop_signals=None
+        )
+    else:
+        # Start the bot polling
+        application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
 
 
 if __name__ == '__main__':